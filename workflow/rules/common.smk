@@ -1139,6 +1139,19 @@ def get_fallbacks_for_report(fallback_type):
     return inner
 
 
+def get_fallback_indices_for_report(fallback_type):
+    """Returns paths to the faidx indices of the fallback sequences. Samples without fallback sequences ("main.fasta") are skipped."""
+
+    def inner(wildcards):
+        return [
+            f"{path}.fai"
+            for path in get_fallbacks_for_report(fallback_type)(wildcards)
+            if path != "resources/genomes/main.fasta"
+        ]
+
+    return inner
+
+
 def get_pattern_by_technology(
     wildcards,
     illumina_pattern=None,
@@ -138,6 +138,15 @@ rule overview_table_patient_csv:
         ),
         pseudo_contigs=get_fallbacks_for_report("pseudo"),
         consensus_contigs=get_fallbacks_for_report("consensus"),
+        # faidx indices are used to look up the contig lengths
+        initial_contigs_fai=expand_samples_for_date(
+            "results/{{date}}/contigs/checked/{sample}.fasta.fai",
+        ),
+        polished_contigs_fai=expand_samples_for_date(
+            "results/{{date}}/contigs/masked/polished/{sample}.fasta.fai",
+        ),
+        pseudo_contigs_fai=get_fallback_indices_for_report("pseudo"),
+        consensus_contigs_fai=get_fallback_indices_for_report("consensus"),
         kraken=get_kraken_output,
         pangolin=get_pangolin_for_report,
         bcf=expand_samples_for_date(
@@ -157,8 +166,9 @@ rule overview_table_patient_csv:
         mode=config["mode"],
     log:
         "logs/{date}/patient-overview-table.log",
+    threads: 8
     conda:
-        "../envs/pysam.yaml"
+        "../envs/python.yaml"
     script:
         "../scripts/generate-overview-table.py"
 
@@ -7,32 +7,92 @@ import sys
 
 sys.stderr = open(snakemake.log[0], "w")
 
-import json
-
+import multiprocessing
+import re
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+import orjson
 import pandas as pd
 import pysam
 
 KRAKEN_FILTER_KRITERIA = "D"
 
+# maximum number of characters Excel can display in a single cell
+MAX_CELL_LENGTH = 32767
 
-def iter_with_samples(inputfiles):
-    return zip(snakemake.params.samples, inputfiles)
+AA_ALPHABET_TRANSLATION = {
+    "Gly": "G",
+    "Ala": "A",
+    "Leu": "L",
+    "Met": "M",
+    "Phe": "F",
+    "Trp": "W",
+    "Lys": "K",
+    "Gln": "Q",
+    "Glu": "E",
+    "Ser": "S",
+    "Pro": "P",
+    "Val": "V",
+    "Ile": "I",
+    "Cys": "C",
+    "Tyr": "Y",
+    "His": "H",
+    "Arg": "R",
+    "Asn": "N",
+    "Asp": "D",
+    "Thr": "T",
+}
+AA_ALPHABET_PATTERN = re.compile("|".join(map(re.escape, AA_ALPHABET_TRANSLATION)))
+# most HGVSp alterations are plain substitutions like Gly142Asp
+AA_SUBSTITUTION_PATTERN = re.compile(
+    r"(?P<ref>[A-Z][a-z]{2})(?P<pos>\d+)(?P<alt>[A-Z][a-z]{2})"
+)
+
+samples = snakemake.params.samples
+# (feature, alteration) pairs of the mutations of interest
+mth = [
+    (feature, alteration)
+    for feature, alterations in snakemake.params.mth.items()
+    for alteration in alterations
+]
 
 
-def is_patient_report():
-    return snakemake.params.mode == "patient"
+def map_samples(func, inputfiles, mapper=map):
+    return dict(zip(samples, mapper(func, inputfiles)))
 
 
-data = pd.DataFrame(index=snakemake.params.samples)
+def is_patient_report():
+    return snakemake.params.mode == "patient"
 
 
-# add kraken estimates
-species_columns = pd.DataFrame()
-for sample, file in iter_with_samples(snakemake.input.kraken):
+def iter_annotated_variants(bcf):
+    # let bcftools extract the ANN text instead of decoding it via pysam records,
+    # AF is still read via pysam since bcftools prints floats with 6 digits only
+    with pysam.VariantFile(bcf, "rb") as infile, subprocess.Popen(
+        ["bcftools", "query", "-f", "%INFO/ANN\n", bcf],
+        stdout=subprocess.PIPE,
+        stderr=sys.stderr,
+        text=True,
+    ) as bcftools:
+        for record, anns in zip(infile, bcftools.stdout):
+            anns = anns.rstrip("\n")
+            if anns == ".":
+                raise ValueError(f"record without ANN annotation in {bcf}")
+            yield record.samples[0]["AF"][0], anns.split(",")
+    if bcftools.returncode != 0:
+        raise subprocess.CalledProcessError(bcftools.returncode, bcftools.args)
+
+
+def get_kraken_estimates(file):
     kraken_results = pd.read_csv(
         file,
         delimiter="\t",
         names=["%", "covered", "assigned", "code", "taxonomic ID", "name"],
+        usecols=["%", "code", "name"],
+        engine="c",
     )
     kraken_results["name"] = kraken_results["name"].str.strip()
 
@@ -63,79 +123,174 @@ for sample, file in iter_with_samples(snakemake.input.kraken):
     kraken_results = kraken_results.reindex(
         columns=[eukaryota, bacteria, viruses, sars_cov2, unclassified]
     ).fillna(0)
-    kraken_results["sample"] = sample
-    species_columns = pd.concat([species_columns, kraken_results], ignore_index=True)
+    return kraken_results.iloc[0]
 
-data = data.join(species_columns.set_index("sample"))
 
-# add numbers of raw reads
-for sample, file in iter_with_samples(snakemake.input.reads_raw):
+def get_number_reads(file, stage):
     if "fastq-read-counts" in file:
         with open(file) as infile:
             number_reads = infile.read().strip()
     else:
-        with open(file) as infile:
-            number_reads = json.load(infile)["summary"]["before_filtering"][
-                "total_reads"
-            ]
-    data.loc[sample, "Raw Reads (#)"] = int(number_reads)
+        with open(file, "rb") as infile:
+            number_reads = orjson.loads(infile.read())["summary"][stage]["total_reads"]
+    return int(number_reads)
 
-# add numbers of trimmed reads
-for sample, file in iter_with_samples(snakemake.input.reads_trimmed):
-    if "fastq-read-counts" in file:
-        with open(file) as infile:
-            number_reads = infile.read().strip()
-    else:
-        with open(file) as infile:
-            number_reads = json.load(infile)["summary"]["after_filtering"][
-                "total_reads"
-            ]
-    data.loc[sample, "Trimmed Reads (#)"] = int(number_reads)
 
-# add numbers of reads used for assembly
-for sample, file in iter_with_samples(snakemake.input.reads_used_for_assembly):
+def get_number_filtered_reads(file):
     with open(file) as infile:
-        data.loc[sample, "Filtered Reads (#)"] = int(infile.read())
+        return int(infile.read())
 
 
-def register_contig_lengths(assemblies, name):
-    for sample, file in iter_with_samples(assemblies):
-        if file == "resources/genomes/main.fasta":
-            data.loc[sample, name] = 0
-        else:
-            with pysam.FastxFile(file) as infile:
-                data.loc[sample, name] = max(len(contig.sequence) for contig in infile)
+def get_largest_contig_length(file):
+    if file == "resources/genomes/main.fasta":
+        return 0
+    # take the lengths from the faidx index instead of reading the sequences
+    with pysam.FastaFile(file) as infile:
+        return max(infile.lengths, default=0)
 
 
-if is_patient_report():
-    # add lengths of Initial contigs
-    register_contig_lengths(snakemake.input.initial_contigs, "Largest Contig (bp)")
+def get_largest_contig_lengths(files):
+    return [get_largest_contig_length(file) for file in files]
 
-    # add lengths of polished contigs
-    register_contig_lengths(snakemake.input.polished_contigs, "De Novo Sequence (bp)")
 
-    # add lengths of pseudo assembly
-    register_contig_lengths(snakemake.input.pseudo_contigs, "Pseudo Sequence (bp)")
+def translate_alteration(alteration):
+    substitution = AA_SUBSTITUTION_PATTERN.fullmatch(alteration)
+    if substitution is not None:
+        ref, pos, alt = substitution.group("ref", "pos", "alt")
+        return (
+            f"{AA_ALPHABET_TRANSLATION.get(ref, ref)}{pos}"
+            f"{AA_ALPHABET_TRANSLATION.get(alt, alt)}"
+        )
+    # fall back to a full scan for deletions, insertions, frameshifts etc.
+    return AA_ALPHABET_PATTERN.sub(
+        lambda match: AA_ALPHABET_TRANSLATION[match.group(0)], alteration
+    )
+
 
-    # add lengths of Consensus assembly
-    register_contig_lengths(
-        snakemake.input.consensus_contigs, "Consensus Sequence (bp)"
+# many records share the same protein alteration, hence translate each only once
+@lru_cache(maxsize=None)
+def translate_hgvsp(hgvsp):
+    enssast_id, alteration = hgvsp.split(":", 1)
+    _prefix, alteration = alteration.split(".", 1)
+    return translate_alteration(alteration)
+
+
+def fmt_variants(variants, max_length=None):
+    entries = []
+    length = -1
+    for hgvsp, vaf in variants.items():
+        entry = f"{hgvsp}:{vaf:.3f}"
+        # account for the separating whitespace
+        length += len(entry) + 1
+        if max_length is not None and length > max_length:
+            return "Too many variants to display"
+        entries.append(entry)
+    return " ".join(sorted(entries))
+
+
+def get_variants(file):
+    vafs = []
+    anns = []
+    for vaf, record_anns in iter_annotated_variants(file):
+        vafs.extend([vaf] * len(record_anns))
+        anns.extend(record_anns)
+
+    annotations = pd.DataFrame({"vaf": vafs})
+    fields = (
+        pd.Series(anns, dtype=object)
+        .str.split("|", n=12, expand=True)
+        .reindex(columns=[3, 11])
+    )
+    annotations["feature"] = fields[3]
+    annotations["hgvsp"] = fields[11]
+    annotations = annotations[annotations["hgvsp"].fillna("") != ""].copy()
+    if annotations.empty:
+        return "", ""
+
+    alterations = annotations["hgvsp"].map(translate_hgvsp)
+    annotations["hgvsp"] = annotations["feature"] + ":" + alterations
+    of_interest = pd.MultiIndex.from_arrays([annotations["feature"], alterations]).isin(
+        mth
     )
 
+    # Duplicate calls can occur if there are multiple genomic variants
+    # that lead to the same protein alteration.
+    # We just report the protein alteration here, so what matters to us is the
+    # variant call with the highest VAF.
+    # TODO in principle, the different alterations could even be complementary.
+    # Hence, one could try to determine that and provide a joint vaf.
+    mutations_of_interest = annotations[of_interest].groupby("hgvsp")["vaf"].max()
+    other_mutations = annotations[~of_interest].groupby("hgvsp")["vaf"].max()
+
+    return fmt_variants(mutations_of_interest), fmt_variants(
+        other_mutations, max_length=MAX_CELL_LENGTH
+    )
+
+
+# The kraken reports and variant calls of each sample are independent and
+# expensive to parse, hence parse them in parallel. Workers have to be forked,
+# because this script cannot be re-imported by spawned processes.
+with ProcessPoolExecutor(
+    max_workers=snakemake.threads, mp_context=multiprocessing.get_context("fork")
+) as executor:
+    kraken_estimates = map_samples(
+        get_kraken_estimates, snakemake.input.kraken, executor.map
+    )
+    variants = map_samples(get_variants, snakemake.input.bcf, executor.map)
+
+# values of each column, by sample
+columns = defaultdict(dict)
+
+
+# add kraken estimates
+for sample, estimates in kraken_estimates.items():
+    for column, estimate in estimates.items():
+        columns[column][sample] = estimate
+
+# add numbers of raw reads
+columns["Raw Reads (#)"] = map_samples(
+    partial(get_number_reads, stage="before_filtering"), snakemake.input.reads_raw
+)
+
+# add numbers of trimmed reads
+columns["Trimmed Reads (#)"] = map_samples(
+    partial(get_number_reads, stage="after_filtering"), snakemake.input.reads_trimmed
+)
+
+# add numbers of reads used for assembly
+columns["Filtered Reads (#)"] = map_samples(
+    get_number_filtered_reads, snakemake.input.reads_used_for_assembly
+)
+
+
+if is_patient_report():
+    # add lengths of initial contigs, polished contigs, pseudo and consensus assembly
+    assemblies = {
+        "Largest Contig (bp)": snakemake.input.initial_contigs,
+        "De Novo Sequence (bp)": snakemake.input.polished_contigs,
+        "Pseudo Sequence (bp)": snakemake.input.pseudo_contigs,
+        "Consensus Sequence (bp)": snakemake.input.consensus_contigs,
+    }
+    for sample, lengths in map_samples(
+        get_largest_contig_lengths, list(zip(*assemblies.values()))
+    ).items():
+        for column, length in zip(assemblies, lengths):
+            columns[column][sample] = length
+
     # add type of assembly use:
     for ele in snakemake.params.assembly_used:
         sample, used = ele.split(",")
         if "pseudo" == used:
-            data.loc[sample, "Best Quality"] = "Pseudo"
+            columns["Best Quality"][sample] = "Pseudo"
         elif "normal" == used:
-            data.loc[sample, "Best Quality"] = "De Novo"
+            columns["Best Quality"][sample] = "De Novo"
         elif "consensus" == used:
-            data.loc[sample, "Best Quality"] = "Consensus"
+            columns["Best Quality"][sample] = "Consensus"
         elif "not-accepted" == used:
-            data.loc[sample, "Best Quality"] = "not accepted by QA"
+            columns["Best Quality"][sample] = "not accepted by QA"
 
     # add pangolin results
-    for sample, file in iter_with_samples(snakemake.input.pangolin):
+    for sample, file in zip(samples, snakemake.input.pangolin):
         pangolin_results = pd.read_csv(file)
         assert (
             pangolin_results.shape[0] == 1
@@ -158,88 +313,25 @@ if is_patient_report():
             #         varcount = f" ({varcount})"
             # pangolin_call = f"{lineage}{varcount}"
             pangolin_call = f"{lineage}"
-        data.loc[sample, "Pango Lineage"] = pangolin_call
+        columns["Pango Lineage"][sample] = pangolin_call
         if scorpio == "None":
             scorpio_call = "-"
         else:
             scorpio_call = f"{scorpio}"
-        data.loc[sample, "WHO Label"] = scorpio_call
-        data["WHO Label"].fillna("-", inplace=True)
-        data["WHO Label"].replace({"nan": "-"}, inplace=True)
+        columns["WHO Label"][sample] = scorpio_call
 
 
 # add variant calls
-AA_ALPHABET_TRANSLATION = {
-    "Gly": "G",
-    "Ala": "A",
-    "Leu": "L",
-    "Met": "M",
-    "Phe": "F",
-    "Trp": "W",
-    "Lys": "K",
-    "Gln": "Q",
-    "Glu": "E",
-    "Ser": "S",
-    "Pro": "P",
-    "Val": "V",
-    "Ile": "I",
-    "Cys": "C",
-    "Tyr": "Y",
-    "His": "H",
-    "Arg": "R",
-    "Asn": "N",
-    "Asp": "D",
-    "Thr": "T",
-}
+for sample, (voc_mutations, other_mutations) in variants.items():
+    columns["VOC Mutations"][sample] = voc_mutations
+    columns["Other Mutations"][sample] = other_mutations
+
+
+data = pd.DataFrame(columns, index=samples)
+
+if is_patient_report():
+    data["WHO Label"] = data["WHO Label"].fillna("-").replace({"nan": "-"})
 
-for sample, file in iter_with_samples(snakemake.input.bcf):
-    mutations_of_interest = {}
-    other_mutations = {}
-
-    def insert_entry(variants, hgvsp, vaf):
-        prev_vaf = variants.get(hgvsp)
-        if prev_vaf is None or prev_vaf < vaf:
-            # Only insert if there was no entry before or it had a smaller vaf.
-            # Such duplicate calls can occur if there are multiple genomic variants
-            # that lead to the same protein alteration.
-            # We just report the protein alteration here, so what matters to us is the
-            # variant call with the highest VAF.
-            # TODO in principle, the different alterations could even be complementary.
-            # Hence, one could try to determine that and provide a joint vaf.
-            variants[hgvsp] = vaf
-
-    def fmt_variants(variants):
-        return " ".join(sorted(f"{hgvsp}:{vaf:.3f}" for hgvsp, vaf in variants.items()))
-
-    with pysam.VariantFile(file, "rb") as infile:
-        for record in infile:
-            vaf = record.samples[0]["AF"][0]
-            for ann in record.info["ANN"]:
-                ann = ann.split("|")
-                hgvsp = ann[11]
-                enssast_id = ann[6]
-                feature = ann[3]
-                if hgvsp:
-                    # TODO think about regex instead of splitting
-                    enssast_id, alteration = hgvsp.split(":", 1)
-                    _prefix, alteration = alteration.split(".", 1)
-                    for triplet, amino in AA_ALPHABET_TRANSLATION.items():
-                        alteration = alteration.replace(triplet, amino)
-
-                    hgvsp = f"{feature}:{alteration}"
-                    entry = (hgvsp, f"{vaf:.3f}")
-                    if alteration in snakemake.params.mth.get(feature, {}):
-                        insert_entry(mutations_of_interest, hgvsp, vaf)
-                    else:
-                        insert_entry(other_mutations, hgvsp, vaf)
-
-    data.loc[sample, "VOC Mutations"] = fmt_variants(mutations_of_interest)
-    data.loc[sample, "Other Mutations"] = fmt_variants(other_mutations)
-
-
-data["Other Mutations"][
-    data["Other Mutations"].str.len() > 32767
-] = "Too many variants to display"
 
 int_cols = [
     "Raw Reads (#)",
@@ -256,7 +348,9 @@ if is_patient_report():
     ]
 
 
-data[int_cols] = data[int_cols].fillna("0").applymap(lambda x: "{0:,}".format(int(x)))
+int_data = data[int_cols].fillna(0).astype("int64")
+for col in int_cols:
+    data[col] = int_data[col].map("{:,}".format)
 data = data.loc[:, (data != "0").any(axis=0)]
 data.index.name = "Sample"
 data.sort_index(inplace=True)